@@ -3,14 +3,25 @@ Filters on data from a TraceFile.
 
 @author: wjschakel
 """
-from abc import ABC, abstractmethod
+from abc import ABC
+from collections.abc import Mapping
+import itertools
+import operator
 
-from pandas import DataFrame
+import numpy as np
+from pandas import Categorical, DataFrame, Series
+from pandas.api.types import is_string_dtype
+
+
+# unique numbers for filters that are only equal to themselves, an id() may be reused after a filter is garbage collected
+_unique_keys = itertools.count()
 
 
 class Filter(ABC):
     """
-    Defines a filter on trace file data.
+    Defines a filter on trace file data. Sub classes define a mask on columns, which may be the column arrays of a TraceFile or
+    a DataFrame. Sub classes that only define apply() on a DataFrame are also supported. Filters with equal parameters are equal,
+    such that results can be reused for an equal filter.
     
     Attributes:
     -----------
@@ -24,12 +35,44 @@ class Filter(ABC):
         """
         self._column = column
     
-    @abstractmethod
     def apply(self, data_frame: DataFrame) -> DataFrame:
         """
-        Applies the filter.
+        Applies the filter. Sub classes that define this method should return a subset of the rows that keeps their labels,
+        such that the rows can be found in the trace file.
+        """
+        return data_frame.iloc[self.get_mask(data_frame)]
+    
+    def get_mask(self, columns: Mapping) -> np.ndarray:
+        """
+        Returns a boolean array of the rows to keep, given a mapping of column names to columns. Sub classes define either this
+        method or apply().
+        """
+        raise NotImplementedError('Filter ' + type(self).__name__ + ' defines neither get_mask() nor apply().')
+    
+    def get_key(self) -> tuple:
+        """
+        Returns a key that is equal for equal filters. The key does not refer to the filter itself, such that it can be stored
+        without keeping the filter alive. The parameters of _get_key() are only used when the class of the filter defines it, as
+        a sub class may add parameters that the inherited _get_key() does not contain.
+        """
+        if '_get_key' in type(self).__dict__:
+            return (type(self), self._get_key())
+        return (type(self), Filter._get_key(self))
+    
+    def _get_key(self) -> tuple:
+        """
+        Returns the parameters that define the filter. By default a filter is only equal to itself, sub classes with parameters
+        override this method.
         """
-        pass
+        if '_unique_key' not in self.__dict__:
+            self._unique_key = next(_unique_keys)
+        return (self._unique_key,)
+    
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Filter) and self.get_key() == other.get_key()
+    
+    def __hash__(self) -> int:
+        return hash(self.get_key())
 
 class Range(Filter):
     """
@@ -59,18 +102,14 @@ class Range(Filter):
         self._min_inclusive = min_inclusive
         self._max_inclusive = max_inclusive 
     
-    def apply(self, data_frame: DataFrame) -> DataFrame:
-        if self._min_inclusive:
-            min_bool = data_frame[self._column] >= self._min
-        else:
-            min_bool = data_frame[self._column] > self._min
-        
-        if self._max_inclusive:
-            max_bool = data_frame[self._column] <= self._max
-        else:
-            max_bool = data_frame[self._column] < self._max
-            
-        return data_frame[min_bool & max_bool]
+    def _get_key(self) -> tuple:
+        return (self._column, self._min, self._max, self._min_inclusive, self._max_inclusive)
+    
+    def get_mask(self, columns: Mapping) -> np.ndarray:
+        values = np.asarray(columns[self._column])
+        min_op = operator.ge if self._min_inclusive else operator.gt
+        max_op = operator.le if self._max_inclusive else operator.lt
+        return min_op(values, self._min) & max_op(values, self._max)
 
 class Area(Filter):
     
@@ -85,8 +124,11 @@ class Area(Filter):
         """
         return self._area
     
-    def apply(self, data_frame: DataFrame) -> DataFrame:
-        return self._pos_filter.apply(self._t_filter.apply(data_frame))
+    def _get_key(self) -> tuple:
+        return (self._t_filter._get_key(), self._pos_filter._get_key())
+    
+    def get_mask(self, columns: Mapping) -> np.ndarray:
+        return self._t_filter.get_mask(columns) & self._pos_filter.get_mask(columns)
 
 class InSet(Filter):
     """
@@ -94,13 +136,28 @@ class InSet(Filter):
     
     Attributes:
     -----------
-    _values : set
-        Set of string values to keep.
+    _values : frozenset
+        Set of string values to keep, frozen such that the filter does not change when the given set is changed.
     """
     
     def __init__(self, column: str, values: set[str]):
         super().__init__(column)
-        self._values = values
+        self._values = frozenset(values)
+    
+    def _get_key(self) -> tuple:
+        return (self._column, self._values)
         
-    def apply(self, data_frame: DataFrame) -> DataFrame:
-        return data_frame[data_frame[self._column].isin(self._values)]
\ No newline at end of file
+    def get_mask(self, columns: Mapping) -> np.ndarray:
+        """
+        For a categorical column the values are translated to category codes once, such that rows are compared on their integer
+        codes. Categories of name columns are strings, values such as a type index 1 are matched as '1'.
+        """
+        column = columns[self._column]
+        if isinstance(column, Series):
+            column = column.array
+        if isinstance(column, Categorical):
+            categories = column.categories
+            values = {str(value) for value in self._values} if is_string_dtype(categories) else self._values
+            codes = [categories.get_loc(value) for value in values if value in categories]
+            return np.isin(column.codes, codes)
+        return Series(column, copy=False).isin(self._values).to_numpy()
\ No newline at end of file
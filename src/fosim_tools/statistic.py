@@ -4,11 +4,46 @@ Statistics on trace file data.
 @author: wjschakel
 """
 from abc import abstractmethod, ABC
+from weakref import WeakKeyDictionary
+
+import numpy as np
 
 from fosim_tools.filter import Area
 from fosim_tools.trace_file import TraceFile
 
 
+# columns of which totals are derived together in one pass over the ids
+_total_columns = ('t (s)', 'pos (m)')
+
+# totals per column of each revision of each source trace file, shared by all Total statistics
+_totals = WeakKeyDictionary()
+
+# number of revisions per source trace file of which totals are cached, the oldest are removed first
+_max_cached_revisions = 256
+
+
+def _sum_range_per_id(ids: np.ndarray, columns: list[np.ndarray]) -> list[float]:
+    """
+    Returns, per column, the summation over all ids of the difference between the maximum and minimum value. Values are sorted
+    by id, unless they already are, such that each id is a contiguous segment that is reduced at once.
+    """
+    if ids.size == 0:
+        return [0.0 for _ in columns]
+    steps = np.diff(ids)
+    order = None
+    if (steps < 0).any():
+        order = np.argsort(ids, kind='stable')
+        steps = np.diff(ids[order])
+    starts = np.r_[0, np.flatnonzero(steps) + 1]
+    totals = []
+    for values in columns:
+        if order is not None:
+            values = values[order]
+        ranges = np.maximum.reduceat(values, starts) - np.minimum.reduceat(values, starts)
+        totals.append(float(ranges.sum(dtype=np.float64)))
+    return totals
+
+
 class Statistic(ABC):
     """
     Super class of all statistic values.
@@ -58,31 +93,25 @@ class Statistic(ABC):
         """
         Raises an error if a column with given name is not in the trace file.
         """
-        if not column in trace_file.get_data_frame():
+        if not trace_file.has_column(column):
             raise ValueError('Column ' + column + ' is not in the provided trace file.')
 
 
 class Total(Statistic):
     """
     Intermediate class for statistics that are a summation of the difference of each vehicles's maximum and minimum values of a
-    column defined by a sub class. This class caches the value for a given trace file, as these statistics are reused in others.
+    column defined by a sub class. Totals are cached per revision of a source trace file, as these statistics are reused in
+    others, also on trace files that are filtered again with equal filters. The totals of all commonly used columns are derived
+    together, such that the ids are sorted only once.
     
     Attributes:
     -----------
     _column : str
         Column name.
-    
-    _value : float
-        Cached value.
-    
-    _trace_file : TraceFile
-        Trace file of cached value.
     """
     
     def __init__(self, column: str):
         self._column = column
-        self._value = None
-        self._trace_file = None
     
     @abstractmethod
     def get_label(self) -> str:
@@ -91,15 +120,20 @@ class Total(Statistic):
     def get_si(self, trace_file: TraceFile) -> float:
         self._check_column(self._column, trace_file)
         self._check_column('id', trace_file)
-        if trace_file is not self._trace_file:
-            ids = trace_file.get_data_frame()['id'].unique()
-            value = 0.0
-            for vehicle_id in ids:
-                id_data = trace_file.get_data_frame()[trace_file.get_data_frame()['id'] == vehicle_id]
-                value = value + id_data[self._column].max() - id_data[self._column].min()
-            self._value = value
-            self._trace_file = trace_file
-        return self._value
+        source_totals = _totals.setdefault(trace_file.get_source(), {})
+        totals = source_totals.get(trace_file.get_revision())
+        if totals is None or self._column not in totals:
+            columns = [column for column in _total_columns if trace_file.has_column(column)]
+            if self._column not in columns:
+                columns.append(self._column)
+            values = _sum_range_per_id(trace_file.get_column('id'), [trace_file.get_column(column) for column in columns])
+            # a new dict is stored, rather than updating a dict that another thread may be reading
+            totals = {**(totals or {}), **dict(zip(columns, values))}
+            source_totals[trace_file.get_revision()] = totals
+            # the oldest revisions are taken from a copy of the keys, as other threads may add revisions meanwhile
+            while len(source_totals) > _max_cached_revisions:
+                source_totals.pop(next(iter(list(source_totals))), None)
+        return totals[self._column]
 
 
 class TotalTimeSpent(Total):
@@ -264,7 +298,7 @@ class NumberOfLaneChanges(Statistic):
     def get(self, trace_file: TraceFile) -> float:
         self._check_column('fromln', trace_file)
         self._check_column('tolane', trace_file)
-        return len(trace_file.get_data_frame().index)
+        return trace_file.get_row_count()
     
     def get_si(self, trace_file: TraceFile) -> float:
         return self.get(trace_file)
@@ -3,6 +3,10 @@ Table to display multiple statistics on console or to get multiple statistics as
 
 @author: wjschakel
 """
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from pandas import isna
 from pandas.core.frame import DataFrame
 
 from fosim_tools.statistic import Statistic
@@ -15,8 +19,17 @@ class Table(object):
     
     Attributes:
     -----------
+    _labels : list[str]
+        Label per statistic.
+    
+    _values : list[float]
+        Value per statistic.
+    
+    _units : list[str]
+        Unit per statistic.
+    
     _data_frame : DataFrame
-        Data frame of label, value and unit per statistic.
+        Data frame of label, value and unit per statistic, created when first requested.
     """
 
     def __init__(self, statistics: list[Statistic], trace_files: list[TraceFile]):
@@ -25,28 +38,33 @@ class Table(object):
         """
         if len(statistics) is not len(trace_files):
             raise ValueError('Statistics list and trace file list are not of equal length.')
-        labels = []
-        values = []
-        units = []
-        for i in range(len(statistics)):
-            labels.append(statistics[i].get_label())
-            values.append(statistics[i].get(trace_files[i]))
-            units.append(statistics[i].get_unit())
-        # first column name is an empty string such that the table prints nicely
-        self._data_frame = DataFrame({'': labels, 'Value': values, 'Unit': units})
+        self._labels = [statistic.get_label() for statistic in statistics]
+        self._units = [statistic.get_unit() for statistic in statistics]
+        # statistics are derived concurrently, numpy releases the GIL in most of the work
+        with ThreadPoolExecutor(max_workers=max(1, min(len(statistics), os.cpu_count() or 1))) as executor:
+            self._values = list(executor.map(lambda statistic, trace_file: statistic.get(trace_file), statistics, trace_files))
+        self._data_frame = None
     
     def print_to_console(self, decimal_places: int=2):
         """
         Prints the table to console.
         """
-        print(self._data_frame.to_string(
-            formatters={
-                '': '{{:<{}s}}'.format(self._data_frame[''].str.len().max()).format, # left-align labels by appending spaces
-                'Value': '{{:.{}f}}'.format(decimal_places).format # decimal places in values
-            }, index=False))
+        labels = self._labels
+        # missing values print as 'NaN', as in the data frame
+        values = ['NaN' if isna(value) else '{:.{}f}'.format(value, decimal_places) for value in self._values]
+        units = self._units
+        # left-align labels, right-align values and units under their header
+        row = '{{:<{}s}} {{:>{}s}} {{:>{}s}}'.format(max(map(len, labels), default=0), max(map(len, values + ['Value'])),
+                                                    max(map(len, units + ['Unit'])))
+        lines = [row.format('', 'Value', 'Unit')]
+        lines.extend(row.format(label, value, unit) for label, value, unit in zip(labels, values, units))
+        print('\n'.join(lines))
     
     def as_data_frame(self) -> DataFrame:
         """
         Returns the table as a data frame. This is a safe copy of an internal data frame.
         """
+        if self._data_frame is None:
+            # first column name is an empty string such that the table prints nicely
+            self._data_frame = DataFrame({'': self._labels, 'Value': self._values, 'Unit': self._units})
         return self._data_frame.copy()
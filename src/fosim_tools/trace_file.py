@@ -4,42 +4,46 @@ represent a subset of the data.
 
 @author: wjschakel
 """
+from collections.abc import KeysView, Mapping
 import re
+from weakref import WeakKeyDictionary
 
+import numpy as np
 from pandas.core.frame import DataFrame
 
 from fosim_tools.filter import Filter
 import pandas as pd
 
+try:
+    import pyarrow  # @UnusedImport, parses delimited files through pandas when available
+    _delimited_engine = 'pyarrow'
+except ImportError:
+    _delimited_engine = 'c'
 
-def _float_converter(value: str) -> float:
-    try:
-        return float(value)
-    except:
-        return float('NaN')
 
-
-def _int_converter(value: str) -> int:
-    try:
-        return int(value)
-    except:
-        return -1
-
-
-_converters = {'t (s)': _float_converter,
-          'fromln': _int_converter,
-          'tolane': _int_converter,
-          'from a': _float_converter,
-          'to a': _float_converter,
-          'pos (m)': _float_converter,
-          'v (m/s)': _float_converter,
+# numeric columns, with the value for cells that are not a number
+_numeric_columns = {'t (s)': float('NaN'),
+          'fromln': -1,
+          'tolane': -1,
+          'from a': float('NaN'),
+          'to a': float('NaN'),
+          'pos (m)': float('NaN'),
+          'v (m/s)': float('NaN'),
           # 'type': str of name
-          'id': _int_converter,
-          'lane': _int_converter,
+          'id': -1,
+          'lane': -1,
           # 'origin': str of name
           # 'dest': str of name
-          'tt (s)': _float_converter,
-          'dt (s)': _float_converter}
+          'tt (s)': float('NaN'),
+          'dt (s)': float('NaN')}
+
+# delimiter between column names in the header of a fixed width file
+_fixed_width_header_delimiter = re.compile(r'\s{2,}')
+
+# columns with names or indices of names, which are kept as categorical strings
+_name_columns = {'type': 'category',
+          'origin': 'category',
+          'dest': 'category'}
 
 
 class TraceFile(object):
@@ -49,35 +53,35 @@ class TraceFile(object):
     
     Attributes
     ----------
+    _columns : dict[str, np.ndarray]
+        Contiguous array per column that contains the data, name columns are categorical. Data is transformed in to the right
+        type. What columns are contained depends on the original trace file that was loaded.
+    
     _data_frame : DataFrame
-        DataFrame that contains the data. Data is transformed in to the right type. What columns are contained depends on the
-        original trace file that was loaded.
+        DataFrame on the column arrays, created when first requested.
+    
+    _filtered : WeakKeyDictionary[Filter, TraceFile]
+        Filtered trace files per filter, such that filtering again with the same filter does not repeat the work.
+    
+    _column_names : frozenset[str]
+        Names of the columns.
+    
+    _row_count : int
+        Number of rows.
+    
+    _revision : tuple[tuple, ...]
+        Keys of the filters applied to the loaded trace file to obtain this trace file, empty for a loaded trace file.
     
     """
 
-    def __init__(self, filename: str, fos_file: str=None):
+    def __init__(self, filename: str, fos_file: str=None, precision: str='float64'):
         """
-        Constructor
+        Constructor. Columns with decimal values are stored with the given precision, where 'float32' halves the memory and
+        memory bandwidth of these columns at the cost of about 7 significant digits.
         """
+        if precision not in ('float32', 'float64'):
+            raise ValueError('Precision ' + str(precision) + ' is not supported, use float32 or float64.')
         
-        # try to find the right format of the file
-        if filename:
-            with open(filename, 'r') as file:
-                header = file.readline(-1);
-                if '  ' in header:
-                    # Fixed width, delimiter "  ...", decimal separator "."
-                    delimiter = r'\s{2,}'
-                    decimal = '.'
-                elif ';' in header:
-                    # Dutch CSV, delimiter ";", decimal separator ","
-                    delimiter = ';'
-                    decimal = ','
-                else:
-                    # Pure CSV, delimiter ",", decimal separator "."
-                    delimiter = ','
-                    decimal = '.'
-         
-        converters = dict(_converters)
         # sources = dict()
         # sinks = dict()
         types = dict()
@@ -86,50 +90,176 @@ class TraceFile(object):
                 for line in file:
                     # if line.startswith('source') and not line.startswith('source to sink'):
                     #     index, field_value = self._get_fos_field(line, 4)
-                    #     if not sources:
-                    #
-                    #         def source_converter(value: str):
-                    #             return sources[int(value)]
-                    #
-                    #         converters['origin'] = source_converter
-                    #     sources[index] = field_value
+                    #     sources[str(index)] = field_value
                     # elif line.startswith('sink'):
                     #     index, field_value = self._get_fos_field(line, 4)
-                    #     if not sinks:
-                    #
-                    #         def sink_converter(value: str):
-                    #             return sinks[int(value)]
-                    #
-                    #         converters['dest'] = sink_converter
-                    #     sinks[index] = field_value
+                    #     sinks[str(index)] = field_value
                     if line.startswith('vehicle types') and not line.startswith('vehicle types:'):
                         index, field_value = self._get_fos_field(line, 2)
-                        if not types:
-
-                            def type_converter(value: str):
-                                return types[int(value)]
-
-                            converters['type'] = type_converter
-                        types[index] = field_value
+                        types[str(index)] = field_value
         
-        if str != None and len(filename):
-            self._data_frame = pd.read_csv(
-                filename, delimiter=delimiter, decimal=decimal, header=0, converters=converters, engine='python')
-            self._data_frame.dropna(inplace=True)
+        self._columns = {}
+        self._data_frame = None
+        self._filtered = WeakKeyDictionary()
+        self._row_count = 0
+        self._revision = ()
+        if filename:
+            with open(filename, 'r') as file:
+                # try to find the right format of the file
+                header = file.readline(-1);
+                if '  ' in header:
+                    # Fixed width, delimiter "  ...", decimal separator "."; column names may contain single spaces, so
+                    # they are taken from the header and values are separated by any whitespace
+                    delimiter = r'\s+'
+                    decimal = '.'
+                    names = _fixed_width_header_delimiter.split(header.strip())
+                    engine = 'c'
+                    bad_lines = 'skip'
+                elif ';' in header:
+                    # Dutch CSV, delimiter ";", decimal separator ","
+                    delimiter = ';'
+                    decimal = ','
+                    names = header.strip().split(delimiter)
+                    engine = _delimited_engine
+                    bad_lines = 'error'
+                else:
+                    # Pure CSV, delimiter ",", decimal separator "."
+                    delimiter = ','
+                    decimal = '.'
+                    names = header.strip().split(delimiter)
+                    engine = _delimited_engine
+                    bad_lines = 'error'
+                
+                # the header is consumed, the data is read from the same file; repeated header lines in a fixed width file
+                # split in to more fields than there are columns, and are skipped, while other formats raise an error on lines
+                # with too many fields; the pyarrow parser is multi-threaded but does not support whitespace delimiters, nor
+                # index_col=False as it never takes the first column as index, and it would infer integer categories so name
+                # columns are read as strings and made categorical afterwards; it also fails on an empty cell in an integer
+                # column, so these are read as strings and converted below
+                if engine == 'c':
+                    options = {'index_col': False, 'dtype': _name_columns}
+                else:
+                    dtype = {column: str for column in _name_columns}
+                    dtype.update({column: str for column, invalid in _numeric_columns.items()
+                                  if isinstance(invalid, int) and column in names})
+                    options = {'dtype': dtype}
+                data_frame = pd.read_csv(
+                    file, delimiter=delimiter, decimal=decimal, header=None, names=names, on_bad_lines=bad_lines, engine=engine,
+                    **options)
+            # columns with cells that are not a number are read as strings, these are converted per column; the C parser reads
+            # large files in chunks, so these columns may also contain values of chunks without such cells; integer columns
+            # with an empty cell are read as decimal values; all integer columns are stored as int64 with -1 for invalid cells
+            for column, invalid in _numeric_columns.items():
+                if column not in data_frame:
+                    continue
+                values = data_frame[column]
+                if not pd.api.types.is_numeric_dtype(values):
+                    if decimal != '.':
+                        values = values.astype(str).str.replace(decimal, '.', regex=False)
+                    values = pd.to_numeric(values, errors='coerce')
+                if isinstance(invalid, int) and values.dtype != np.int64:
+                    values = values.fillna(invalid).astype('int64')
+                data_frame[column] = values
+            if types and 'type' in data_frame:
+                # mapped per category; a type index that is not in the .fos file keeps its raw value
+                data_frame['type'] = data_frame['type'].astype('category').map(lambda index: types.get(index, index))
+            # rows with a value that is not a number, or an empty cell in another column, are removed; integer columns have -1
+            # for these values and are never empty
+            valid = np.ones(len(data_frame.index), dtype=bool)
+            for column in data_frame:
+                if pd.api.types.is_float_dtype(data_frame[column]):
+                    valid &= np.isfinite(data_frame[column].to_numpy())
+                elif not pd.api.types.is_integer_dtype(data_frame[column]):
+                    valid &= data_frame[column].notna().to_numpy()
+            if not valid.all():
+                data_frame = data_frame.loc[valid]
+            for column in data_frame:
+                if column in _name_columns:
+                    # categories of removed rows, such as those of repeated header lines, are dropped
+                    self._columns[column] = data_frame[column].astype('category').array.remove_unused_categories()
+                elif pd.api.types.is_float_dtype(data_frame[column]):
+                    self._columns[column] = np.ascontiguousarray(data_frame[column].to_numpy(dtype=precision))
+                else:
+                    self._columns[column] = np.ascontiguousarray(data_frame[column].to_numpy())
+            self._row_count = len(data_frame.index)
+        self._column_names = frozenset(self._columns)
     
     def filter(self, filt: Filter) -> 'TraceFile':
         """
-        Filters the data frame and returns it in a new trace file. The original trace file and data frame are not affected.
+        Filters the data and returns it in a new trace file. The original trace file and its data are not affected. The new
+        trace file only stores the indices of the remaining rows, data is copied when it is first requested. Filtering again
+        with the same filter returns the same trace file.
         """
-        out = TraceFile('')
-        out._data_frame = filt.apply(self._data_frame)
+        out = self._filtered.get(filt)
+        if out is None:
+            out = self._filter(filt)
+            self._filtered[filt] = out
         return out
     
+    def _filter(self, filt: Filter) -> 'TraceFile':
+        """
+        Creates a new trace file with the rows that pass the filter.
+        """
+        return FilteredTraceFile(self, self._get_rows(filt), (filt.get_key(),))
+    
+    def _get_rows(self, filt: Filter) -> np.ndarray:
+        """
+        Returns the positions of the rows in this trace file that pass the filter.
+        """
+        if type(filt).apply is not Filter.apply:
+            # sub class that only defines apply(), as filters did before get_mask() was introduced
+            data_frame = self.get_data_frame()
+            rows = data_frame.index.get_indexer(filt.apply(data_frame).index)
+            if (rows < 0).any():
+                raise ValueError('Filter ' + type(filt).__name__ + ' returned rows with labels that are not in the data frame.')
+            return rows
+        return np.flatnonzero(filt.get_mask(self._columns))
+    
+    def get_source(self) -> 'TraceFile':
+        """
+        Returns the loaded trace file that contains the data of this trace file, which is this trace file if it is not filtered.
+        """
+        return self
+    
+    def get_revision(self) -> tuple[tuple, ...]:
+        """
+        Returns the keys of the filters applied to the source trace file to obtain this trace file. Filters with equal parameters
+        have equal keys, such that an equal revision of the same source trace file represents the same data, also when the
+        filters and trace files are created again. The keys do not keep the filters alive.
+        """
+        return self._revision
+    
+    def get_column(self, column: str) -> np.ndarray:
+        """
+        Returns the underlying array of a column for processing. This is not a safe copy and should not be altered.
+        """
+        return self._columns[column]
+    
+    def has_column(self, column: str) -> bool:
+        """
+        Returns whether a column with given name is in this trace file.
+        """
+        return column in self._column_names
+    
+    def get_row_count(self) -> int:
+        """
+        Returns the number of rows in this trace file.
+        """
+        return self._row_count
+    
+    def get_column_names(self) -> KeysView[str]:
+        """
+        Returns the names of the columns in this trace file.
+        """
+        return self._columns.keys()
+    
     def get_data_frame(self) -> DataFrame:
         """
-        Returns the underlying data frame for processing. This is not a safe copy and should not be altered. This data is made
-        available only to calculate statistics from the data.
+        Returns a data frame on the underlying column arrays for processing. This is not a safe copy and should not be altered.
+        This data is made available only to calculate statistics from the data.
         """
+        if self._data_frame is None:
+            self._data_frame = DataFrame(dict(self._columns), copy=False)
         return self._data_frame
         
     def _get_fos_field(self, line: str, field_number: int):
@@ -141,3 +271,68 @@ class TraceFile(object):
         index = int(semi[0].split(' ')[-1])
         field_value = re.split(r'\s+', semi[1].strip(), maxsplit=field_number - 1)[-1]
         return (index, field_value)
+
+
+class FilteredTraceFile(TraceFile):
+    """
+    A FilteredTraceFile represents a subset of the rows of a loaded TraceFile. Filtering it again further reduces the indices into
+    the same loaded TraceFile, such that no intermediate data is copied.
+    
+    Attributes
+    ----------
+    _source : TraceFile
+        Loaded trace file that contains the data.
+    
+    _indices : np.ndarray
+        Indices of the rows in the source trace file.
+    
+    """
+    
+    def __init__(self, source: TraceFile, indices: np.ndarray, revision: tuple[tuple, ...]):
+        """
+        Constructor
+        """
+        super().__init__('')
+        self._source = source
+        self._indices = indices
+        self._revision = revision
+        self._columns = _GatheredColumns(source, indices)
+        self._column_names = source._column_names
+        self._row_count = len(indices)
+    
+    def _filter(self, filt: Filter) -> TraceFile:
+        return FilteredTraceFile(self._source, self._indices[self._get_rows(filt)], self._revision + (filt.get_key(),))
+    
+    def get_source(self) -> TraceFile:
+        return self._source
+    
+    def get_data_frame(self) -> DataFrame:
+        """
+        Returns a data frame on the filtered rows, labeled with their row index in the data frame of the source trace file.
+        """
+        if self._data_frame is None:
+            self._data_frame = DataFrame(dict(self._columns), index=self._indices, copy=False)
+        return self._data_frame
+
+
+class _GatheredColumns(Mapping):
+    """
+    Mapping of column name to the rows of a column in a trace file at given indices. Each column is gathered when it is first
+    accessed.
+    """
+    
+    def __init__(self, source: TraceFile, indices: np.ndarray):
+        self._source = source
+        self._indices = indices
+        self._gathered = {}
+    
+    def __getitem__(self, column: str) -> np.ndarray:
+        if column not in self._gathered:
+            self._gathered[column] = self._source.get_column(column)[self._indices]
+        return self._gathered[column]
+    
+    def __iter__(self):
+        return iter(self._source.get_column_names())
+    
+    def __len__(self) -> int:
+        return len(self._source.get_column_names())
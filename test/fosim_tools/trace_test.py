@@ -3,15 +3,35 @@ Tests reading and filtering a trace file.
 
 @author: wjschakel
 '''
+import contextlib
+import gc
+import io
+import os
+import tempfile
 import unittest
+from unittest import mock
+import warnings
+import weakref
 
-from fosim_tools import statistic
-from fosim_tools.filter import InSet, Range, Area
+import numpy as np
+from pandas.errors import DtypeWarning, ParserError
+
+from fosim_tools import statistic, trace_file
+from fosim_tools.filter import Filter, InSet, Range, Area
 from fosim_tools.statistic import TotalTimeSpent, TotalDistanceTraveled, MeanSpeed, Density, Flow, NumberOfLaneChanges
 from fosim_tools.table import Table
 from fosim_tools.trace_file import TraceFile
 
 
+# parser engines of delimited files, pyarrow is used when it is installed
+_delimited_engines = ['c']
+try:
+    import pyarrow  # @UnusedImport
+    _delimited_engines.append('pyarrow')
+except ImportError:
+    pass
+
+
 class Test(unittest.TestCase):
 
     def test_name(self):
@@ -20,8 +40,8 @@ class Test(unittest.TestCase):
         filename = '../resources/Inv_21.trc'
         detections = TraceFile(filename, fos_file=fos_file)
         filtered_detections = detections.filter(InSet('type', {'1', '2'})).filter(Range('t (s)', 15.0, 18.0))
-        print(detections._data_frame.head(5))
-        print(filtered_detections._data_frame.head(5))
+        print(detections.get_data_frame().head(5))
+        print(filtered_detections.get_data_frame().head(5))
         
         # Note: values are nonsense because .ddt is not a vehicles samples file.
         # (It does however contain columns 'id', 'pos (m)' and 't (s)', which we need to technically test statistics.)
@@ -51,6 +71,220 @@ class Test(unittest.TestCase):
         print(table.as_data_frame().head(3))
         table.print_to_console(decimal_places=4)
 
+    def test_totals(self):
+        
+        travel_time = TraceFile('../resources/Inv_21.ddt')
+        self.assertEqual(travel_time.get_row_count(), 14041)
+        tts = TotalTimeSpent()
+        tdt = TotalDistanceTraveled()
+        area = Area(600.0, 1800.0, 1000.0, 2000.0)
+        self.assertAlmostEqual(tts.get(travel_time), 147.5427075)
+        self.assertAlmostEqual(tdt.get(travel_time), 5263.5)
+        self.assertAlmostEqual(MeanSpeed(tts, tdt).get(travel_time), 35.67441650750513)
+        self.assertAlmostEqual(Density(tts, area).get(travel_time), 442.6281225)
+        self.assertAlmostEqual(Flow(tdt, area).get(travel_time), 15790.5)
+        self.assertAlmostEqual(tts.get(travel_time.filter(area)), 16.8769475)
+        self.assertAlmostEqual(tdt.get(travel_time.filter(area)), 966.5)
+        
+        lane_changes = TraceFile('../resources/Inv_21.lct')
+        self.assertEqual(NumberOfLaneChanges().get(lane_changes), 7767)
+    
+    def test_filter_again(self):
+        
+        travel_time = TraceFile('../resources/Inv_21.ddt')
+        filtered = travel_time.filter(InSet('type', {'1', '2'})).filter(Range('t (s)', 600.0, 1800.0))
+        self.assertEqual(filtered.get_row_count(), len(filtered.get_data_frame().index))
+        np.testing.assert_array_equal(filtered.get_data_frame().index, filtered.get_data_frame().index.sort_values())
+        tts = TotalTimeSpent()
+        value = tts.get(filtered)
+        
+        # equal filters give the same trace file while in use, or the same revision and cached totals when created again
+        types = InSet('type', {'1', '2'})
+        self.assertIs(travel_time.filter(types), travel_time.filter(InSet('type', {'1', '2'})))
+        again = travel_time.filter(InSet('type', ['2', '1'])).filter(Range('t (s)', 600.0, 1800.0))
+        self.assertEqual(again.get_revision(), filtered.get_revision())
+        self.assertEqual(tts.get(again), value)
+        
+        # filters in another order, or with integer type values, give the same rows but not the same revision
+        other = travel_time.filter(Range('t (s)', 600.0, 1800.0)).filter(InSet('type', {1, 2}))
+        self.assertNotEqual(other.get_revision(), filtered.get_revision())
+        self.assertAlmostEqual(tts.get(other), value)
+        np.testing.assert_array_equal(other.get_column('id'), filtered.get_column('id'))
+    
+    def test_sub_class_key(self):
+        
+        class MinSpeedRange(Range):
+            
+            def __init__(self, minimum: float, maximum: float, min_speed: float):
+                super().__init__('t (s)', minimum, maximum)
+                self._min_speed = min_speed
+            
+            def get_mask(self, columns):
+                return super().get_mask(columns) & (np.asarray(columns['v (m/s)']) >= self._min_speed)
+        
+        # the sub class does not define _get_key(), so it is only equal to itself as it has more parameters than Range
+        travel_time = TraceFile('../resources/Inv_21.ddt')
+        all_speeds = MinSpeedRange(0.0, 3600.0, 0.0)
+        high_speeds = MinSpeedRange(0.0, 3600.0, 30.0)
+        self.assertNotEqual(all_speeds, high_speeds)
+        self.assertNotEqual(all_speeds, Range('t (s)', 0.0, 3600.0))
+        tts = TotalTimeSpent()
+        value = tts.get(travel_time.filter(all_speeds))
+        filtered = travel_time.filter(high_speeds)
+        self.assertLess(filtered.get_row_count(), travel_time.filter(all_speeds).get_row_count())
+        self.assertEqual(filtered.get_row_count(), np.count_nonzero(travel_time.get_column('v (m/s)') >= 30.0))
+        self.assertLess(tts.get(filtered), value)
+    
+    def test_apply_sub_class(self):
+        
+        class IdFilter(Filter):
+            
+            def __init__(self, vehicle_id: int, reset_index: bool=False):
+                super().__init__('id')
+                self._id = vehicle_id
+                self._reset_index = reset_index
+            
+            def apply(self, data_frame):
+                out = data_frame[data_frame[self._column] == self._id]
+                return out.reset_index(drop=True) if self._reset_index else out
+        
+        travel_time = TraceFile('../resources/Inv_21.ddt')
+        filtered = travel_time.filter(Range('t (s)', 600.0, 1800.0)).filter(IdFilter(474))
+        self.assertEqual(filtered.get_row_count(), 2)
+        np.testing.assert_array_equal(filtered.get_column('id'), 474)
+        
+        # rows that lost their labels can not be found in the trace file
+        with self.assertRaises(ValueError):
+            travel_time.filter(Range('t (s)', 600.0, 1800.0)).filter(IdFilter(474, reset_index=True))
+    
+    def test_table(self):
+        
+        class Missing(statistic.Statistic):
+            
+            def __init__(self):
+                pass
+            
+            def get_label(self):
+                return 'Missing'
+            
+            def get_unit(self):
+                return '-'
+            
+            def get_unit_si(self):
+                return '-'
+            
+            def get(self, trace_file):
+                return float('NaN')
+            
+            def get_si(self, trace_file):
+                return float('NaN')
+        
+        travel_time = TraceFile('../resources/Inv_21.ddt')
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            Table([TotalTimeSpent(), Missing()], [travel_time, travel_time]).print_to_console()
+        self.assertEqual(output.getvalue().splitlines(), ['                  Value Unit',
+                                                          'Total time spent 147.54    h',
+                                                          'Missing             NaN    -'])
+    
+    def test_release(self):
+        
+        travel_time = TraceFile('../resources/Inv_21.ddt')
+        tts = TotalTimeSpent()
+        references = []
+        for i in range(10):
+            filt = Area(100.0 * i, 100.0 * i + 600.0, 0.0, 3000.0)
+            filtered = travel_time.filter(filt)
+            tts.get(filtered)
+            references.append((weakref.ref(filt), weakref.ref(filtered)))
+        del filt, filtered
+        gc.collect()
+        for filt, filtered in references:
+            self.assertIsNone(filt())
+            self.assertIsNone(filtered())
+        self.assertEqual(len(travel_time._filtered), 0)
+        
+        # the totals are released with the source trace file
+        reference = weakref.ref(travel_time)
+        del travel_time
+        gc.collect()
+        self.assertIsNone(reference())
+        self.assertNotIn(reference, statistic._totals.keyrefs())
+    
+    def test_precision(self):
+        
+        travel_time = TraceFile('../resources/Inv_21.ddt', precision='float32')
+        self.assertEqual(travel_time.get_column('t (s)').dtype, np.float32)
+        self.assertEqual(travel_time.get_column('id').dtype, np.int64)
+        self.assertAlmostEqual(TotalTimeSpent().get(travel_time), 147.5427075, places=4)
+        with self.assertRaises(ValueError):
+            TraceFile('../resources/Inv_21.ddt', precision='float16')
+    
+    def test_invalid_cells(self):
+        
+        for engine in _delimited_engines:
+            for filename in ['../resources/invalid.csv', '../resources/invalid_nl.csv']:
+                with self.subTest(engine=engine, filename=filename):
+                    with mock.patch.object(trace_file, '_delimited_engine', engine):
+                        # an empty id is kept as -1, rows with an empty position or that are not a number are removed
+                        data = TraceFile(filename)
+                        self.assertEqual(data.get_row_count(), 3)
+                        self.assertEqual(data.get_column('id').dtype, np.int64)
+                        np.testing.assert_array_equal(data.get_column('id'), [3, -1, 7])
+                        np.testing.assert_array_equal(data.get_column('t (s)'), [1.5, 2.5, 4.5])
+                        np.testing.assert_array_equal(data.get_column('pos (m)'), [10.0, 20.0, 15.0])
+                        self.assertEqual(list(data.get_column('type').categories), ['1', '2'])
+
+    def test_too_many_fields(self):
+        
+        contents = {'fields.csv': 't (s),id,pos (m),type\n1.5,3,10.0,1\n2.5,4,20.0,2,9\n',
+                    'fields_nl.csv': 't (s);id;pos (m);type\n1,5;3;10,0;1\n2,5;4;20,0;2;9\n'}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, content in contents.items():
+                filename = os.path.join(directory, name)
+                with open(filename, 'w') as file:
+                    file.write(content)
+                for engine in _delimited_engines:
+                    with self.subTest(engine=engine, filename=name):
+                        with mock.patch.object(trace_file, '_delimited_engine', engine):
+                            # only repeated header lines in fixed width files are skipped
+                            with self.assertRaises(ParserError):
+                                TraceFile(filename)
+    
+    def test_empty_text_cells(self):
+        
+        contents = {'notes.csv': 't (s),id,pos (m),type,note\n1.5,3,10.0,1,a\n2.5,4,20.0,2,\n3.5,5,30.0,1,b\n',
+                    'notes_nl.csv': 't (s);id;pos (m);type;note\n1,5;3;10,0;1;a\n2,5;4;20,0;2;\n3,5;5;30,0;1;b\n'}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, content in contents.items():
+                filename = os.path.join(directory, name)
+                with open(filename, 'w') as file:
+                    file.write(content)
+                for engine in _delimited_engines:
+                    with self.subTest(engine=engine, filename=name):
+                        with mock.patch.object(trace_file, '_delimited_engine', engine):
+                            # rows with an empty cell in a column that is not known are also removed
+                            data = TraceFile(filename)
+                            self.assertEqual(list(data.get_column('note')), ['a', 'b'])
+                            np.testing.assert_array_equal(data.get_column('id'), [3, 5])
+    
+    def test_invalid_cells_in_later_chunk(self):
+        
+        # the C parser reads large files in chunks, a repeated header line in a later chunk gives columns of mixed types
+        rows = 300000
+        lines = ['t (s);id;pos (m);type']
+        lines.extend('{},5;{};{},0;1'.format(row, row // 10, row) for row in range(rows))
+        lines.insert(rows - 10, lines[0])
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'later_chunk.csv')
+            with open(filename, 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            with mock.patch.object(trace_file, '_delimited_engine', 'c'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', DtypeWarning)
+                data = TraceFile(filename)
+        self.assertEqual(data.get_row_count(), rows)
+        np.testing.assert_array_equal(data.get_column('id'), np.arange(rows) // 10)
+        np.testing.assert_array_equal(data.get_column('t (s)'), np.arange(rows) + 0.5)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.test_name']